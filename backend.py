@@ -6,45 +6,171 @@ Backend bridge:
 """
 
 import asyncio
-import json
+import heapq
+import logging
 import os
 import time
+import zlib
 import aiohttp
+import msgpack
 from gmqtt import Client as MQTTClient
-from websockets import serve  # websockets >= 10
+from websockets import broadcast, serve  # websockets >= 14 (asyncio implementation)
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        """Serialize obj to compact UTF-8 JSON bytes."""
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:  # orjson not installed: fall back to stdlib json
+    import json
+
+    def json_dumps(obj) -> bytes:
+        """Serialize obj to compact UTF-8 JSON bytes."""
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+try:
+    import uvloop
+except ImportError:  # uvloop not installed (e.g. Windows): default asyncio loop
+    uvloop = None
+
 # Load environment variables from .env
 load_dotenv()
 
+# Per-message debug output goes through logging so it costs nothing when disabled
+logging.basicConfig(format="%(message)s", level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger("bridge")
+
 # MQTT configs
 MQTT_BROKER = os.getenv("MQTT_BROKER")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 TOPIC = os.getenv("TOPIC", "devices/+/metrics")
+ALERT_TOPIC = os.getenv("ALERT_TOPIC", "devices/+/alerts")
+ALERT_LEAF = ALERT_TOPIC.rsplit("/", 1)[-1]
+# Agents publish on TOPIC + ".mp" for MessagePack and append ".z" when zlib-compressed.
+# A trailing wildcard level already matches those topics (and "devices/#.z" is invalid).
+if TOPIC.rsplit("/", 1)[-1] in ("#", "+"):
+    METRICS_TOPICS = [TOPIC]
+else:
+    METRICS_TOPICS = [TOPIC + suffix for suffix in ("", ".z", ".mp", ".mp.z")]
 
 # WebSocket configs
 WS_HOST = os.getenv("WS_HOST", "0.0.0.0")
 WS_PORT = int(os.getenv("WS_PORT", "6789"))
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "50"))
 
 # App configs
 PRUNE_SECONDS = int(os.getenv("PRUNE_SECONDS", "30"))
 CPU_ALERT_TH = float(os.getenv("CPU_ALERT_TH", "90"))
 SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
 SUMMARY_INTERVAL = int(os.getenv("SUMMARY_INTERVAL", "60"))
+ALERT_COOLDOWN_SECONDS = int(os.getenv("ALERT_COOLDOWN_SECONDS", "60"))
 
 clients = set()
 device_state = {}
 last_seen = {}
+# One (last_seen at push time, device_id) entry per tracked device, oldest first
+expiry_heap = []
+# Encoded '"<device_id>":' member prefix, built once per tracked device
+envelope_prefix = {}
+last_alert = {}  # device_id -> monotonic time of the last Slack CPU alert
+
+# Encoded active snapshot, reused until a device updates or expires
+snapshot_cache = {"expires": 0.0, "count": 0, "payload": b""}
+
+# Latest value per device since the last flush, sent to clients as one frame
+pending_updates = {}
+flush_event = asyncio.Event()
+
+# Set by on_message; cleared once a Slack summary has been built
+summary_dirty = asyncio.Event()
+
+# Shared Slack HTTP session (keeps the webhook connection warm); opened in main()
+slack = {"session": None}
+
+
+def device_id_from_topic(topic):
+    """Return <id> from a devices/<id>/metrics topic, or None for other layouts."""
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == "devices" and parts[1]:
+        return parts[1]
+    return None
+
+
+def encode_devices(raw_by_device):
+    """Join {device_id: raw JSON payload} into one JSON object without re-parsing."""
+    return b"{" + b",".join(
+        envelope_prefix[did] + raw for did, raw in raw_by_device.items()
+    ) + b"}"
+
+
+def prune_expired(now):
+    """Drop devices whose last update is older than PRUNE_SECONDS.
+
+    Only the heap head is inspected, so the cost is proportional to the number
+    of entries that reached the cutoff rather than to the whole fleet. Entries
+    that were refreshed since being pushed are re-pushed with their newer time.
+    """
+    cutoff = now - PRUNE_SECONDS
+    while expiry_heap and expiry_heap[0][0] < cutoff:
+        _, did = heapq.heappop(expiry_heap)
+        seen = last_seen[did]
+        if seen < cutoff:
+            del last_seen[did]
+            del device_state[did]
+            del envelope_prefix[did]
+        else:
+            heapq.heappush(expiry_heap, (seen, did))
 
 
 def active_snapshot():
-    """Return only devices that have updated within PRUNE_SECONDS."""
-    now = time.time()
-    return {
-        did: payload
-        for did, payload in device_state.items()
-        if (now - last_seen.get(did, 0)) <= PRUNE_SECONDS
-    }
+    """Return {device_id: raw JSON payload} for devices updated within PRUNE_SECONDS.
+
+    The returned dict is the live device state: read it, don't mutate it.
+    """
+    prune_expired(time.monotonic())
+    return device_state
+
+
+def active_snapshot_bytes():
+    """Return (device count, encoded active snapshot), serializing only when stale."""
+    now = time.monotonic()
+    if now < snapshot_cache["expires"]:
+        return snapshot_cache["count"], snapshot_cache["payload"]
+
+    prune_expired(now)
+    snap = device_state
+    # Valid until the oldest tracked device could fall out of the PRUNE_SECONDS window
+    snapshot_cache["expires"] = (
+        expiry_heap[0][0] + PRUNE_SECONDS if expiry_heap else float("inf")
+    )
+    snapshot_cache["count"] = len(snap)
+    snapshot_cache["payload"] = encode_devices(snap) if snap else b""
+    return snapshot_cache["count"], snapshot_cache["payload"]
+
+
+async def broadcast_flusher():
+    """Coalesce pending device updates and broadcast them every FLUSH_INTERVAL_MS."""
+    while True:
+        await flush_event.wait()
+        await asyncio.sleep(FLUSH_INTERVAL_MS / 1000)
+        flush_event.clear()
+
+        batch = pending_updates.copy()
+        pending_updates.clear()
+        if not clients:
+            continue
+
+        log.debug("[WS] broadcasting %d device updates to %d clients", len(batch), len(clients))
+        # Writes the frame into every open connection's buffer without awaiting;
+        # closed peers are skipped and slow ones are dropped by the ping timeout.
+        # Sent as str so the dashboard keeps receiving text frames.
+        broadcast(clients, encode_devices(batch).decode())
 
 
 async def ws_handler(websocket):
@@ -52,10 +178,10 @@ async def ws_handler(websocket):
     clients.add(websocket)
     print(f"[WS] connected. total={len(clients)}")
     try:
-        snap = active_snapshot()
-        if snap:
-            print(f"[WS] sending initial snapshot with {len(snap)} devices")
-            await websocket.send(json.dumps(snap))
+        count, snap = active_snapshot_bytes()
+        if count:
+            print(f"[WS] sending initial snapshot with {count} devices")
+            await websocket.send(snap, text=True)
 
         async for _ in websocket:
             pass
@@ -71,11 +197,17 @@ async def post_slack(text: str):
     if not SLACK_WEBHOOK_URL:
         print("[SLACK] Webhook URL not configured")
         return
+    session = slack["session"]
+    if session is None:
+        print("[SLACK] HTTP session not started")
+        return
     try:
-        async with aiohttp.ClientSession() as session:
-            resp = await session.post(
-                SLACK_WEBHOOK_URL, json={"text": text}, timeout=10
-            )
+        # Pre-encoded body: skips aiohttp's JsonPayload (stdlib dumps + encode)
+        async with session.post(
+            SLACK_WEBHOOK_URL,
+            data=json_dumps({"text": text}),
+            headers={"Content-Type": "application/json"},
+        ) as resp:
             body = await resp.text()
             print(f"[SLACK] status={resp.status}, body={body}")
     except aiohttp.ClientError as err:
@@ -84,6 +216,82 @@ async def post_slack(text: str):
         print(f"[SLACK] unexpected error: {err}")
 
 
+def raise_cpu_alert(device_id, data, now):
+    """Print a CPU alert and post it to Slack, at most once per ALERT_COOLDOWN_SECONDS."""
+    try:
+        cpu = data["cpu_percent"]
+        if cpu < CPU_ALERT_TH:
+            return
+    except (KeyError, TypeError):  # missing or non-numeric cpu_percent
+        return
+    text = (
+        f":rotating_light: CPU ALERT at {device_id} — "
+        f"CPU {cpu:.1f}%, RAM {data.get('mem_percent')}%"
+    )
+    print(f"[ALERT] {text}")
+    if now - last_alert.get(device_id, float("-inf")) >= ALERT_COOLDOWN_SECONDS:
+        last_alert[device_id] = now
+        asyncio.create_task(post_slack(text))
+
+
+def as_samples(data):
+    """Return the samples of a metrics payload: agents publish a batch (list) or one dict."""
+    return data if isinstance(data, list) else [data]
+
+
+def handle_metrics(topic, payload):
+    """Store and forward one metrics payload (a sample or a batch of samples).
+
+    Every payload is parsed once to validate it (one bad device must not
+    break the coalesced frames of all the others), but the original bytes
+    are what gets stored and forwarded.
+    """
+    try:
+        data = json_loads(payload)
+    except ValueError as err:
+        print(f"[MQTT ERROR] could not parse payload: {err}")
+        return
+    samples = as_samples(data)
+    if not samples or not all(isinstance(sample, dict) for sample in samples):
+        print("[MQTT ERROR] payload is not a sample or a non-empty batch of samples")
+        return
+    # str(): the id becomes a JSON object key in the coalesced frames
+    device_id = device_id_from_topic(topic) or str(samples[-1].get("device_id", "unknown"))
+
+    # monotonic: device expiry and alert cooldowns must not jump with NTP
+    now = time.monotonic()
+    if device_id not in last_seen:
+        heapq.heappush(expiry_heap, (now, device_id))
+        envelope_prefix[device_id] = json_dumps(device_id) + b":"
+    device_state[device_id] = payload
+    last_seen[device_id] = now
+    snapshot_cache["expires"] = 0.0
+    summary_dirty.set()
+
+    # queue for the next coalesced WebSocket broadcast
+    if clients:
+        pending_updates[device_id] = payload
+        flush_event.set()
+
+    # 🚨 Slack alert if CPU too high
+    for sample in samples:
+        raise_cpu_alert(device_id, sample, now)
+
+
+def handle_alert(topic, payload):
+    """Handle an alert published by a device (same fields as a metrics sample)."""
+    try:
+        data = json_loads(payload)
+    except ValueError as err:
+        print(f"[MQTT ERROR] could not parse alert: {err}")
+        return
+    if not isinstance(data, dict):
+        print("[MQTT ERROR] alert is not a JSON object")
+        return
+    device_id = device_id_from_topic(topic) or str(data.get("device_id", "unknown"))
+    raise_cpu_alert(device_id, data, time.monotonic())
+
+
 async def mqtt_loop():
     """Main MQTT loop: subscribes and processes messages."""
     client = MQTTClient("backend-bridge")
@@ -92,8 +300,12 @@ async def mqtt_loop():
     def on_connect(c, flags, rc, properties):
         print(f"[MQTT] CONNECTED rc={rc}, flags={flags}, props={properties}")
         try:
-            c.subscribe(TOPIC, qos=1)
-            print(f"[MQTT] SUBSCRIBE request sent to {TOPIC}")
+            # Metrics are periodic and idempotent: at-most-once is enough.
+            # Alerts are rare and consequential: keep the broker acknowledging them.
+            for metrics_topic in METRICS_TOPICS:
+                c.subscribe(metrics_topic, qos=0)
+            c.subscribe(ALERT_TOPIC, qos=1)
+            print(f"[MQTT] SUBSCRIBE request sent to {', '.join(METRICS_TOPICS)}, {ALERT_TOPIC}")
         except Exception as e:
             print(f"[MQTT ERROR] failed to subscribe: {e}")
 
@@ -104,40 +316,28 @@ async def mqtt_loop():
         print(f"[MQTT] SUBSCRIBED mid={mid}, qos={qos}, props={properties}")
 
     def on_message(_c, topic, payload, _qos, _properties):
-        """Handle incoming MQTT messages from devices."""
-        try:
-            raw = payload.decode() if isinstance(payload, (bytes, bytearray)) else payload
-            print(f"[MQTT RAW] topic={topic}, payload={raw[:100]}...")
-            data = json.loads(raw)
-        except Exception as e:
-            print(f"[MQTT ERROR] could not parse payload: {e}")
+        """Route device messages: alerts (QoS 1) vs periodic metrics (QoS 0)."""
+        # gmqtt always delivers bytes: slice for the log, never decode the whole payload
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[MQTT RAW] topic=%s, payload=%r...", topic, payload[:100])
+        if topic.rsplit("/", 1)[-1] == ALERT_LEAF:
+            handle_alert(topic, payload)
             return
-
-        device_id = data.get("device_id", "unknown")
-        device_state[device_id] = data
-        last_seen[device_id] = time.time()
-
-        # broadcast to WebSocket clients
-        if clients:
-            msg = json.dumps({device_id: data})
-            print(f"[WS] broadcasting update for {device_id} to {len(clients)} clients")
-            for ws in list(clients):
-                try:
-                    asyncio.create_task(ws.send(msg))
-                except Exception as e:
-                    print(f"[WS ERROR] failed to send to client: {e}")
-                    clients.discard(ws)
-
-
-        # 🚨 Slack alert if CPU too high
-        cpu = data.get("cpu_percent")
-        if isinstance(cpu, (int, float)) and cpu >= CPU_ALERT_TH:
-            text = (
-                f":rotating_light: CPU ALERT at {device_id} — "
-                f"CPU {cpu:.1f}%, RAM {data.get('mem_percent')}%"
-            )
-            print(f"[ALERT] {text}")
-            asyncio.create_task(post_slack(text))
+        if topic.endswith(".z"):
+            topic = topic[:-2]
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error as err:
+                print(f"[MQTT ERROR] could not decompress payload: {err}")
+                return
+        if topic.endswith(".mp"):
+            # dashboards and Slack consume JSON: convert once here
+            try:
+                payload = json_dumps(msgpack.unpackb(payload))
+            except (ValueError, TypeError) as err:  # TypeError: bin/ext values aren't JSON
+                print(f"[MQTT ERROR] could not unpack payload: {err}")
+                return
+        handle_metrics(topic, payload)
 
     # Attach callbacks
     client.on_connect = on_connect
@@ -168,45 +368,80 @@ async def mqtt_loop():
         print(f"[MQTT ERROR] failed to connect: {e}")
         return
 
-    while True:
-        await asyncio.sleep(1)
+    # Idle without waking the loop until shutdown cancels us. Dropped sessions
+    # are not an exit condition: gmqtt reconnects (and resubscribes) on its own.
+    stop_event = asyncio.Event()
+    try:
+        await stop_event.wait()
+    finally:
+        await client.disconnect()
+        print("[MQTT] disconnected from broker")
+
+
+# One summary line per device, bound once instead of re-parsing an f-string per row
+SUMMARY_ROW = "{:15} | CPU {}% | RAM {}% | Disk {}% | GPU {}".format
+
+
+def summary_row(did, raw):
+    """Format one summary line from a device's latest raw JSON payload."""
+    try:
+        data = as_samples(json_loads(raw))[-1]
+    except (ValueError, IndexError):
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return SUMMARY_ROW(
+        did,
+        data.get("cpu_percent", "?"),
+        data.get("mem_percent", "?"),
+        data.get("disk_percent", "?"),
+        data.get("gpu_percent", "?"),
+    )
 
 
 async def slack_summary_loop():
     """Periodically send a summary of active devices to Slack."""
     while True:
         await asyncio.sleep(SUMMARY_INTERVAL)
+        if not summary_dirty.is_set():
+            print("[SLACK] no device updates since last summary, skipping")
+            continue
+        summary_dirty.clear()
+
         snapshot = active_snapshot()
         if not snapshot:
             print("[SLACK] no active devices to summarize")
             continue
 
-        lines = ["Metrics summary (last interval):", ""]
-        for did, data in snapshot.items():
-            lines.append(
-                f"{did:15} | CPU {data.get('cpu_percent', '?')}% "
-                f"| RAM {data.get('mem_percent', '?')}% "
-                f"| Disk {data.get('disk_percent', '?')}% "
-                f"| GPU {data.get('gpu_percent', '?')}"
-            )
-
-        formatted = "```\n" + "\n".join(lines) + "\n```"
+        rows = "\n".join(summary_row(did, raw) for did, raw in snapshot.items())
+        formatted = f"```\nMetrics summary (last interval):\n\n{rows}\n```"
         print("[SLACK] sending periodic summary")
         await post_slack(formatted)
 
 
 async def main():
-    """Start WebSocket server, MQTT loop, and Slack summary loop."""
-    async with serve(ws_handler, WS_HOST, WS_PORT):
-        print(f"[WS] server running at ws://{WS_HOST}:{WS_PORT}")
-        await asyncio.gather(
-            mqtt_loop(),
-            slack_summary_loop(),
-        )
+    """Start WebSocket server, MQTT loop, broadcast flusher and Slack summary loop."""
+    session = slack["session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=10),
+    )
+    try:
+        async with serve(ws_handler, WS_HOST, WS_PORT):
+            print(f"[WS] server running at ws://{WS_HOST}:{WS_PORT}")
+            await asyncio.gather(
+                mqtt_loop(),
+                broadcast_flusher(),
+                slack_summary_loop(),
+            )
+    finally:
+        await session.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n[INFO] Backend stopped by user")
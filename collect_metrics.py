@@ -1,16 +1,45 @@
 import asyncio
-import json
+import atexit
+import logging
+import math
 import os
+import re
+import shutil
 import ssl
-import subprocess
 import time
+import zlib
+from typing import NamedTuple
+import msgpack
 import psutil
+import pynvml
 from gmqtt import Client as MQTTClient
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        """Serialize obj to compact UTF-8 JSON bytes."""
+        return orjson.dumps(obj)
+except ImportError:  # orjson not installed: fall back to stdlib json
+    import json
+
+    def json_dumps(obj) -> bytes:
+        """Serialize obj to compact UTF-8 JSON bytes."""
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+try:
+    import uvloop
+except ImportError:  # uvloop not installed (e.g. Windows): default asyncio loop
+    uvloop = None
+
 # Load environment variables
 load_dotenv()
 
+# Per-sample output goes through logging: at the default WARNING level nothing is written
+logging.basicConfig(format="%(message)s", level=os.getenv("LOG_LEVEL", "WARNING"))
+log = logging.getLogger("agent")
+
 DEVICE_ID = os.getenv("DEVICE_ID", "device-iot-001")
 MQTT_BROKER = os.getenv("MQTT_BROKER")  # AWS IoT endpoint (xxx-ats.iot.<region>.amazonaws.com)
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
@@ -18,92 +47,355 @@ CA_CERT = os.getenv("CA_CERT", "AmazonRootCA1.pem")
 CLIENT_CERT = os.getenv("CLIENT_CERT", "device.cert.pem")
 CLIENT_KEY = os.getenv("CLIENT_KEY", "device.private.key")
 INTERVAL = int(os.getenv("INTERVAL", "10"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "6"))  # samples per publish
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json")  # "json" or "msgpack"
+COMPRESS_MIN_BYTES = 512  # larger payloads go zlib-compressed to <topic> + ".z"
 TOPIC = f"devices/{DEVICE_ID}/metrics"
+ALERT_TOPIC = f"devices/{DEVICE_ID}/alerts"
+PUBLISH_QUEUE_SIZE = 1024  # messages waiting for the publish worker (offline backlog)
+MAX_SAMPLES_PER_PUBLISH = 360  # caps merged backlog batches well below broker size limits
+DISK_REFRESH_SECONDS = 60  # filesystem usage changes slowly; statvfs at most this often
+CPU_REFRESH_SECONDS = 1.0  # shorter windows give noisy cpu_percent readings
+CPU_COUNT = psutil.cpu_count() or 1
+
+# One Packer for the whole process instead of a fresh one per msgpack.packb() call
+_packer = msgpack.Packer(use_bin_type=True)
 
 # Process reference to measure agent overhead
 process = psutil.Process(os.getpid())
 
+# Last disk usage / system CPU readings (monotonic time, percent)
+_disk_cache = {"ts": float("-inf"), "val": 0.0}
+_cpu_cache = {"ts": float("-inf"), "val": 0.0}
+
+# CPU time counters from the previous sample (system: /proc/stat jiffies, agent: seconds)
+_cpu_prev = {"total": 0, "idle": 0}
+_agent_prev = {"ts": time.monotonic(), "cpu": sum(os.times()[:2])}
+
+if os.path.exists("/proc/stat"):
+    # Linux: parse /proc directly; psutil's cross-platform wrappers cost more than the reads
+    MEMINFO_FIELD = re.compile(rb"^(MemTotal|MemAvailable):\s+(\d+)", re.MULTILINE)
+    VMRSS_FIELD = re.compile(rb"^VmRSS:\s+(\d+)", re.MULTILINE)
+
+    def _read_cpu() -> float:
+        """System CPU % since the previous call, from the aggregate line of /proc/stat."""
+        with open("/proc/stat", "rb") as fh:
+            # user nice system idle iowait irq softirq steal
+            times = [int(v) for v in fh.readline().split()[1:9]]
+        total = sum(times)
+        idle = times[3] + times[4]
+        d_total = total - _cpu_prev["total"]
+        d_idle = idle - _cpu_prev["idle"]
+        _cpu_prev["total"] = total
+        _cpu_prev["idle"] = idle
+        if d_total <= 0:
+            return 0.0
+        return round(100.0 * (d_total - d_idle) / d_total, 1)
+
+    def _read_mem() -> float:
+        """Used RAM % (MemTotal - MemAvailable) from /proc/meminfo."""
+        with open("/proc/meminfo", "rb") as fh:
+            fields = dict(MEMINFO_FIELD.findall(fh.read()))
+        total = int(fields[b"MemTotal"])
+        return round(100.0 * (total - int(fields[b"MemAvailable"])) / total, 1)
+
+    def _read_agent_mem() -> float:
+        """Agent resident set size in MB, from /proc/self/status."""
+        with open("/proc/self/status", "rb") as fh:
+            return int(VMRSS_FIELD.search(fh.read()).group(1)) / 1024
+else:  # non-Linux: psutil fallback
+    def _read_cpu() -> float:
+        """System CPU % since the previous call."""
+        return psutil.cpu_percent(interval=None)
+
+    def _read_mem() -> float:
+        """Used RAM %."""
+        return psutil.virtual_memory().percent
+
+    def _read_agent_mem() -> float:
+        """Agent resident set size in MB."""
+        return process.memory_info().rss / (1024 * 1024)
+
+
+def _read_agent_cpu(now: float) -> float:
+    """Agent CPU since the previous call, as % of the whole machine."""
+    cpu = sum(os.times()[:2])  # user + system seconds of this process
+    elapsed = now - _agent_prev["ts"]
+    used = cpu - _agent_prev["cpu"]
+    _agent_prev["ts"] = now
+    _agent_prev["cpu"] = cpu
+    if elapsed <= 0:
+        return 0.0
+    return round(100.0 * used / elapsed / CPU_COUNT, 1)
+
+
+# NVML is initialised once; GPU-less nodes (no driver / no device) keep None.
+# Probe for the device first so CPU-only edges never try to load the NVML library.
+_HAS_GPU = os.path.exists("/dev/nvidia0") or shutil.which("nvidia-smi") is not None
+GPU_HANDLE = None
+if _HAS_GPU:
+    try:
+        pynvml.nvmlInit()
+        GPU_HANDLE = pynvml.nvmlDeviceGetHandleByIndex(0)
+        atexit.register(pynvml.nvmlShutdown)
+    except pynvml.NVMLError:
+        pass
+
+
+class Sample(NamedTuple):
+    """One metrics sample; field names are the JSON keys the backend and dashboard read."""
+
+    device_id: str
+    timestamp: int
+    cpu_percent: float
+    mem_percent: float
+    disk_percent: float
+    gpu_percent: float | None
+    agent_cpu_percent: float
+    agent_mem_mb: float
+
+
+# Constant part of every JSON sample (keys + device_id) encoded once; per sample only
+# the values are formatted in. "%" in the device id is escaped for the %-template.
+_SAMPLE_JSON = (
+    b'{"device_id":' + json_dumps(DEVICE_ID).replace(b"%", b"%%")
+    + b',"timestamp":%d,"cpu_percent":%s,"mem_percent":%s,"disk_percent":%s'
+    b',"gpu_percent":%s,"agent_cpu_percent":%s,"agent_mem_mb":%s}'
+)
+
+
+def _num(value):
+    """JSON bytes for a reading: null for None and NaN/inf (as orjson writes them)."""
+    if value is None or not math.isfinite(value):
+        return b"null"
+    return b"%r" % value
+
+
+def sample_json(sample):
+    """Encode one Sample as a JSON object using the precomputed template."""
+    return _SAMPLE_JSON % (
+        sample.timestamp,
+        _num(sample.cpu_percent),
+        _num(sample.mem_percent),
+        _num(sample.disk_percent),
+        _num(sample.gpu_percent),
+        _num(sample.agent_cpu_percent),
+        _num(sample.agent_mem_mb),
+    )
+
 
 def collect_metrics():
     """Collect CPU, RAM, Disk, GPU (if available) and agent self-metrics."""
-    cpu = psutil.cpu_percent(interval=None)
-    mem = psutil.virtual_memory().percent
-    disk = psutil.disk_usage("/").percent
+    now = time.monotonic()
+    if now - _cpu_cache["ts"] >= CPU_REFRESH_SECONDS:
+        _cpu_cache["ts"] = now
+        _cpu_cache["val"] = _read_cpu()
+    cpu = _cpu_cache["val"]
+    mem = _read_mem()
+    if now - _disk_cache["ts"] > DISK_REFRESH_SECONDS:
+        _disk_cache["ts"] = now
+        _disk_cache["val"] = psutil.disk_usage("/").percent
+    disk = _disk_cache["val"]
+
+    gpu = None  # No GPU available
+    if GPU_HANDLE is not None:
+        try:
+            gpu = float(pynvml.nvmlDeviceGetUtilizationRates(GPU_HANDLE).gpu)
+        except pynvml.NVMLError:
+            pass
+
+    agent_mem = _read_agent_mem()  # MB
+    agent_cpu = _read_agent_cpu(now)  # % of the whole machine, not per core
 
+    return Sample(DEVICE_ID, int(time.time()), cpu, mem, disk, gpu, agent_cpu, agent_mem)
+
+
+def encode_batch(batch):
+    """Return (topic, payload) for a batch of Samples, zlib-compressed when large.
+
+    JSON arrays go to TOPIC; with PAYLOAD_FORMAT=msgpack the array is packed
+    with MessagePack and published to TOPIC + ".mp".
+    """
+    if PAYLOAD_FORMAT == "msgpack":
+        # keyed maps on the wire, like the JSON objects
+        topic, payload = TOPIC + ".mp", _packer.pack([sample._asdict() for sample in batch])
+    else:
+        topic, payload = TOPIC, b"[" + b",".join(map(sample_json, batch)) + b"]"
+    if len(payload) > COMPRESS_MIN_BYTES:
+        # level 1: most of the ratio on repetitive payloads at a fraction of the CPU
+        return topic + ".z", zlib.compress(payload, 1)
+    return topic, payload
+
+
+def enqueue(queue, item):
+    """Queue a (topic, data, qos) item; when full, drop the oldest to keep fresh data.
+
+    Metric batches are queued as (None, samples, 0) and encoded at publish time.
+    """
     try:
-        out = subprocess.check_output(
-            [
-                "nvidia-smi",
-                "--query-gpu=utilization.gpu,memory.used,memory.total",
-                "--format=csv,noheader,nounits",
-            ]
-        ).decode().strip()
-        gpu_util, _, _ = out.split(",")
-        gpu = float(gpu_util)
-    except Exception:  # noqa: BLE001
-        gpu = None  # No GPU available
-
-    agent_mem = process.memory_info().rss / (1024 * 1024)  # MB
-    agent_cpu = process.cpu_percent(interval=None)  # %
-
-    return {
-        "device_id": DEVICE_ID,
-        "timestamp": int(time.time()),
-        "cpu_percent": cpu,
-        "mem_percent": mem,
-        "disk_percent": disk,
-        "gpu_percent": gpu,
-        "agent_cpu_percent": agent_cpu,
-        "agent_mem_mb": agent_mem,
-    }
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        queue.get_nowait()
+        queue.put_nowait(item)
 
 
-async def main():
-    """Main loop: connect to MQTT broker and periodically publish metrics."""
-    client = MQTTClient(DEVICE_ID)
+def drain(queue):
+    """Remove and return every item currently in the queue."""
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+async def publish_pending(pool, items):
+    """Publish queued items, merging all metric batches into as few publishes as possible.
+
+    Returns the number of metric samples sent.
+    """
+    samples = []
+    for topic, data, qos in items:
+        if topic is None:
+            samples.extend(data)
+        else:
+            await pool.publish(topic, data, qos)
+    for start in range(0, len(samples), MAX_SAMPLES_PER_PUBLISH):
+        topic, payload = encode_batch(samples[start:start + MAX_SAMPLES_PER_PUBLISH])
+        await pool.publish(topic, payload, 0)
+    return len(samples)
+
+
+async def publish_worker(pool, queue):
+    """Publish queued messages so the sampling loop never waits on the broker.
+
+    While the broker is unreachable items stay in the bounded queue; once back
+    online the whole backlog goes out merged instead of one publish per item.
+    """
+    while True:
+        items = [await queue.get()]
+        await pool.wait_online()
+        items.extend(drain(queue))
+        sent = await publish_pending(pool, items)
+        if sent > BATCH_SIZE:
+            print(f"[{DEVICE_ID}] backfilled {sent} samples")
+
+
+def make_ssl_context():
+    """Build the mTLS context once per process; gmqtt reuses it on every reconnect."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.load_verify_locations(CA_CERT)
+    ctx.load_cert_chain(certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
+    ctx.options &= ~ssl.Options.OP_NO_TICKET  # accept session tickets from the broker
+    ctx.set_ciphers("ECDHE+AESGCM")  # TLS 1.2: forward secrecy + AES-GCM (AES-NI / ARMv8 CE)
+    return ctx
+
+
+class MQTTPool:
+    """Single shared TLS/MQTT connection for everything the agent publishes.
+
+    Connects lazily on first use; gmqtt keeps the session alive (keepalive
+    pings) and reconnects it, so every publisher reuses one handshake.
+    """
+
+    def __init__(self, client_id):
+        self.client = MQTTClient(client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.online = asyncio.Event()  # publishes wait while this is clear
+        self._connecting = None
 
     # Event handlers (unused args prefixed with _ to satisfy linting)
-    def on_connect(_client, _flags, _rc, _properties):
+    def _on_connect(self, _client, _flags, _rc, _properties):
         print(f"[{DEVICE_ID}] ✅ Connected to AWS IoT Core")
+        self.online.set()
 
-    def on_disconnect(_client, _packet, _exc=None):
+    def _on_disconnect(self, _client, _packet, _exc=None):
         print(f"[{DEVICE_ID}] ❌ Disconnected from AWS IoT Core")
+        self.online.clear()
+
+    async def connect(self):
+        """Open the connection once; concurrent and later callers share the same attempt."""
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(
+                self.client.connect(MQTT_BROKER, MQTT_PORT, ssl=make_ssl_context())
+            )
+        await self._connecting
+
+    async def wait_online(self):
+        """Return once connected (immediately if already online)."""
+        await self.connect()
+        await self.online.wait()
 
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
+    async def publish(self, topic, payload, qos=0):
+        """Publish on the shared connection, waiting for it to be online."""
+        await self.wait_online()
+        self.client.publish(topic, payload, qos=qos, retain=False)
 
-    # TLS configuration
-    ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    ssl_ctx.load_verify_locations(CA_CERT)
-    ssl_ctx.load_cert_chain(certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
+    async def close(self):
+        """Disconnect if a connection was ever opened."""
+        if self._connecting is not None:
+            await self.client.disconnect()
 
-    # Connect to AWS IoT
-    await client.connect(MQTT_BROKER, MQTT_PORT, ssl=ssl_ctx)
 
+async def main():
+    """Main loop: connect to MQTT broker and periodically publish metrics."""
+    pool = MQTTPool(DEVICE_ID)
+
+    # Connect to AWS IoT up front so bad endpoints/certificates fail at startup
+    await pool.connect()
+
+    queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+    worker = asyncio.create_task(publish_worker(pool, queue))
+
+    batch = []  # samples waiting for the next publish
+    next_tick = time.monotonic()  # absolute deadlines: sampling cadence doesn't drift
     try:
         while True:
             metrics = collect_metrics()
+            batch.append(metrics)
+
+            cpu_pct = metrics.cpu_percent
 
             # Alert on local stdout if CPU > 90%
-            if metrics["cpu_percent"] > 90:
-                print(f"⚠️ WARN: CPU > 90% ({metrics['cpu_percent']}%)")
+            alert = cpu_pct > 90
+            if alert:
+                log.warning("⚠️ WARN: CPU > 90%% (%s%%)", cpu_pct)
+                # Alerts are the only consequential messages: QoS 1 on their own topic
+                enqueue(queue, (ALERT_TOPIC, sample_json(metrics), 1))
 
-            # Debug: agent self resource usage
-            print(
-                f"[DEBUG] agent_cpu={metrics['agent_cpu_percent']}%, "
-                f"agent_mem={metrics['agent_mem_mb']:.2f} MB"
-            )
+            # Debug: agent self resource usage (no lookups/formatting unless enabled)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    "[DEBUG] agent_cpu=%s%%, agent_mem=%.2f MB",
+                    metrics.agent_cpu_percent,
+                    metrics.agent_mem_mb,
+                )
 
-            # Publish metrics to AWS IoT Core
-            client.publish(TOPIC, json.dumps(metrics), qos=1, retain=False)
+            # Publish a batch of samples to AWS IoT Core (immediately on alert).
+            # Periodic telemetry is idempotent: QoS 0 avoids the PUBACK round-trip.
+            if alert or len(batch) >= BATCH_SIZE:
+                enqueue(queue, (None, batch, 0))
+                batch = []
 
-            await asyncio.sleep(INTERVAL)
+            next_tick += INTERVAL
+            delay = next_tick - time.monotonic()
+            if delay < 0:  # overran a whole interval: skip missed ticks, don't burst
+                next_tick -= delay
+                delay = 0
+            await asyncio.sleep(delay)
 
     except asyncio.CancelledError:
         print(f"[{DEVICE_ID}] Agent cancelled")
     finally:
-        await client.disconnect()
+        worker.cancel()
+        if batch:  # don't lose samples collected since the last publish
+            enqueue(queue, (None, batch, 0))
+        if pool.online.is_set():  # offline: nothing to flush to, don't wait on a reconnect
+            await publish_pending(pool, drain(queue))
+        await pool.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
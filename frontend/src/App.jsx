@@ -63,9 +63,12 @@ export default function App() {
           setHistories((prev) => {
             let next = { ...prev };
             for (const [deviceId, pointRaw] of entries) {
-              const point = normalizePoint(pointRaw);
+              // agents publish batches of samples (arrays); accept single points too
+              const points = (Array.isArray(pointRaw) ? pointRaw : [pointRaw]).map(
+                normalizePoint
+              );
               next = ensureArrayHistory(next, deviceId);
-              const arr = next[deviceId].concat(point);
+              const arr = next[deviceId].concat(points);
               // history limit
               next[deviceId] = arr.slice(-MAX_POINTS);
             }